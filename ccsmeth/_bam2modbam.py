@@ -2,7 +2,6 @@ import os
 import argparse
 import pysam
 import re
-import math
 import time
 import tabix
 import pybedtools
@@ -204,8 +203,8 @@ def _convert_locs_to_mmtag(locs, seq_fwseq):
 
 
 def _convert_probs_to_mltag(probs):
-    # force returned values in [0, 255]
-    return [math.floor(prob * 256) if prob < 1 else 255 for prob in probs]
+    # force returned values in [0, 255]; int() truncation is floor() for probs >= 0
+    return [min(int(prob * 256), 255) for prob in probs]
 
 
 def _refill_tags(all_tags, mm_values, ml_values, rm_pulse=True):
@@ -241,13 +240,14 @@ def _worker_process_reads_batch(rreads_q, wreads_q, tabix_file, rm_pulse=True):
         for rread in reads_batch:
             seq_name, flag, ref_name, ref_start, mapq, cigartuples, rnext, pnext, tlen, \
                 seq_seq, seq_qual, all_tags, is_reverse = rread
-            seq_fwdseq = complement_seq(seq_seq) if is_reverse else seq_seq
 
             # MM: Base modifications / methylation, ML:Base modification probabilities tags
             mm_values = ml_values = None
             mm_flag = 0
             locs, probs = query_locs_probs_of_a_read(seq_name, perread_tbx)
             if locs is not None:
+                # only reads with calls need the forward seq
+                seq_fwdseq = complement_seq(seq_seq) if is_reverse else seq_seq
                 try:
                     mm_values = _convert_locs_to_mmtag(locs, seq_fwdseq)
                     ml_values = _convert_probs_to_mltag(probs)
@@ -37,6 +37,7 @@ from .utils.process_utils import display_args
 from .utils.process_utils import nproc_to_call_mods_in_cpu_mode
 from .utils.process_utils import str2bool
 from .utils.process_utils import get_motif_seqs
+from .utils.process_utils import compile_motif_regex
 from .utils.process_utils import index_bam_if_needed2
 # from .utils.process_utils import max_queue_size
 from .utils.process_utils import complement_seq
@@ -50,6 +51,7 @@ from .extract_features import worker_read_split_holebatches_to_queue
 from .extract_features import process_one_holebatch
 from .extract_features import _get_holes
 from .extract_features import _open_inputfile
+from .extract_features import _parse_bool_args
 
 from ._bam2modbam import _get_necessary_alignment_items
 from ._bam2modbam import _convert_locs_to_mmtag
@@ -68,6 +70,11 @@ os.environ['MKL_THREADING_LAYER'] = 'GNU'
 # queue_size_border = max_queue_size
 time_wait = 0.2
 
+# base (as byte value) -> base code, bases not in base2code_dna are coded as 'N'
+_B2C_LUT = np.full(256, base2code_dna['N'], dtype=np.uint8)
+for _base, _code in base2code_dna.items():
+    _B2C_LUT[ord(_base)] = _code
+
 
 # extract features ======================================================
 def _batch_feature_list2s(feature_list):
@@ -100,7 +107,7 @@ def _batch_feature_list2s(feature_list):
 
         sampleinfo.append("\t".join(list(map(str, [chrom, abs_loc, strand, holeid, loc]))))
 
-        fkmers.append(np.array([base2code_dna[x] for x in kmer_seq]))
+        fkmers.append(_B2C_LUT[np.frombuffer(kmer_seq.encode('ascii'), dtype=np.uint8)])
         fpasss.append(np.array([kmer_pass] * len(kmer_seq)))
         fipdms.append(np.array(kmer_ipdm, dtype=float))
         fipdsds.append(np.array(kmer_ipds, dtype=float) if type(kmer_ipds) is not str else 0)
@@ -109,7 +116,7 @@ def _batch_feature_list2s(feature_list):
         fsns.append(np.array(kmer_sn, dtype=float) if type(kmer_sn) is not str else 0)
         fmaps.append(np.array(kmer_map, dtype=float) if type(kmer_map) is not str else 0)
 
-        rkmers.append(np.array([base2code_dna[x] for x in kmer_seq2]))
+        rkmers.append(_B2C_LUT[np.frombuffer(kmer_seq2.encode('ascii'), dtype=np.uint8)])
         rpasss.append(np.array([kmer_pass2] * len(kmer_seq2)))
         ripdms.append(np.array(kmer_ipdm2, dtype=float))
         ripdsds.append(np.array(kmer_ipds2, dtype=float) if type(kmer_ipds2) is not str else 0)
@@ -131,6 +138,8 @@ def worker_extract_features_with_holeinfo(input_header, holebatch_q, features_q,
         input_header2 = pysam.AlignmentHeader.from_dict(input_header)
     else:
         input_header2 = input_header
+    _parse_bool_args(args)
+    args.motif_regex = compile_motif_regex(motifs)
 
     cnt_holesbatch = 0
     total_num_batch, failed_num_batch = 0, 0
@@ -517,7 +526,8 @@ def call_mods(args):
 
         motifs = get_motif_seqs(args.motifs)
 
-        hole_batch_q = Queue()
+        # bounded, as worker_read_split_holebatches_to_queue relies on put() blocking
+        hole_batch_q = Queue(maxsize=(args.threads if args.threads > 1 else 2) * 3)
         features_batch_q = Queue()
         out_info_q = Queue()
 
@@ -378,6 +378,9 @@ def main():
     #                              "the PATH.")
     se_extract.add_argument("--holes_batch", type=int, default=50, required=False,
                             help="number of holes/hifi-reads in an batch to get/put in queues, default 50")
+    se_extract.add_argument("--use_shm", action="store_true", default=False, required=False,
+                            help="[EXPERIMENTAL]pass hole/read batches to the extracting processes through "
+                                 "shared memory instead of pipes, needs enough space in /dev/shm")
     se_extract.add_argument("--is_sn", type=str, default="no", required=False,
                             help="if extracting signal-to-noise features, yes or no, default no")
     se_extract.add_argument("--is_map", type=str, default="no", required=False,
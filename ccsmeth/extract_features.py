@@ -2,18 +2,20 @@ import os
 import argparse
 import time
 import numpy as np
-from statsmodels import robust
 import multiprocessing as mp
 from multiprocessing import Queue
+import queue
 import gzip
 
 import pysam
 from collections import OrderedDict
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
 
 from .utils.process_utils import display_args
 from .utils.process_utils import codecv1_to_frame2
-from .utils.process_utils import get_refloc_of_methysite_in_motif
+from .utils.process_utils import get_refloc_of_methysite_in_motif_regex
+from .utils.process_utils import compile_motif_regex
 from .utils.process_utils import get_motif_seqs
 from .utils.process_utils import complement_seq
 # from .utils.process_utils import base2code_dna
@@ -27,6 +29,8 @@ from .utils.process_utils import index_bam_if_needed2
 # from .utils.process_utils import generate_samtools_index_cmd
 
 from .utils.ref_reader import DNAReference
+from .utils.shared_memory_queue import SharedMemoryQueue
+from .utils.shared_memory_queue import get_shm_free_bytes
 
 from .utils.process_utils import default_ref_loc
 
@@ -36,8 +40,30 @@ from .utils.logging import mylogger
 LOGGER = mylogger(__name__)
 
 code2frames = codecv1_to_frame2()
+CODE2FRAMES_LUT = np.array(code2frames, dtype=np.float64)
+# scipy.stats.norm.ppf(0.75), same as the normalization of statsmodels.robust.scale.mad
+MAD_GAUSSIAN_CONST = 0.6744897501960817
 # queue_size_border = max_queue_size
 time_wait = 0.2
+# pickled size of one read in a holebatch, used to size slots of --use_shm. a hifi read takes ~14 bytes
+# per base (~200KB for a 15kb read), batches larger than a slot go through the pipe
+shm_bytes_per_read = 512 * 1024
+
+# per-process float64 scratch buffers for the kinetics of a read, reused across reads
+_scratch_buffers = {}
+_scratch_min_len = 30000
+
+
+def _get_scratch_buffer(name, length):
+    """
+    get a float64 view of length from the process-local scratch buffer name, the buffer grows as needed.
+    the content is overwritten by the next read, so do not keep references to it
+    """
+    buf = _scratch_buffers.get(name)
+    if buf is None or len(buf) < length:
+        buf = np.empty(max(length, 2 * len(buf) if buf is not None else _scratch_min_len), dtype=np.float64)
+        _scratch_buffers[name] = buf
+    return buf[:length]
 
 
 # check and read some inputs =============================================
@@ -85,6 +111,15 @@ def _get_holes(holeidfile):
 
 
 # read bam/sam inputfile =============================================
+def _arraytag2ndarray(tag_value):
+    """
+    zero-copy view of a B-array tag, pysam returns B-array tags as array.array
+    :param tag_value: array.array
+    :return: np.ndarray
+    """
+    return np.frombuffer(tag_value, dtype=tag_value.typecode)
+
+
 def _get_necessary_items_of_a_alignedsegment(readitem):
     seq_name = readitem.query_name
     qalign_start = readitem.query_alignment_start
@@ -106,12 +141,12 @@ def _get_necessary_items_of_a_alignedsegment(readitem):
     is_reverse = readitem.is_reverse
 
     try:
-        tag_fi = readitem.get_tag("fi")
-        tag_ri = readitem.get_tag("ri")
-        tag_fp = readitem.get_tag("fp")
-        tag_rp = readitem.get_tag("rp")
+        tag_fi = _arraytag2ndarray(readitem.get_tag("fi"))
+        tag_ri = _arraytag2ndarray(readitem.get_tag("ri"))
+        tag_fp = _arraytag2ndarray(readitem.get_tag("fp"))
+        tag_rp = _arraytag2ndarray(readitem.get_tag("rp"))
     except KeyError:
-        tag_fi = tag_ri = tag_fp = tag_rp = []
+        tag_fi = tag_ri = tag_fp = tag_rp = np.empty(0, dtype=np.uint8)
     try:
         tag_fn = readitem.get_tag("fn")
         tag_rn = readitem.get_tag("rn")
@@ -126,167 +161,192 @@ def _get_necessary_items_of_a_alignedsegment(readitem):
         is_reverse, tag_fi, tag_ri, tag_fp, tag_rp, tag_fn, tag_rn, tag_sn
 
 
+def _get_readnum_from_index(inputreads):
+    """
+    get the number of reads from the index of a bam file, without scanning the file
+    :return: number of reads, or None if the input has no (usable) index, e.g. sam or unaligned bam
+    """
+    try:
+        # unmapped already includes the reads without coordinates (nocoordinate)
+        return inputreads.mapped + inputreads.unmapped
+    except (ValueError, AttributeError):
+        return None
+
+
 def worker_read_split_holebatches_to_queue(inputfile, holebatch_q, threads, args):
     LOGGER.info("split_holebatches process-{} starts".format(os.getpid()))
-    inputreads = _open_inputfile(inputfile, args.mode, threads=args.threads)
+    inputreads = _open_inputfile(inputfile, args.mode, threads=threads)
     if inputreads is None:
         holebatch_q.put("kill")
         return
     # TODO: check if input is generated by --by-strand/--hd-finder?
-    if args.mode == "align":
-        # totalnum = inputreads.count()
-        totalnum = inputreads.count(until_eof=True)
-    else:
-        totalnum = inputreads.count(until_eof=True)
-    inputreads.close()
-
-    holebatches = []
-    for i in np.arange(0, totalnum, args.holes_batch):
-        # holebatches.append((i, (i + args.holes_batch)))
-        holebatches.append(i)
-    LOGGER.info("split_holebatches process-{} generates {} "
-                "hole/read batches({})".format(os.getpid(), len(holebatches),
-                                               args.holes_batch))
-
-    with tqdm(total=len(holebatches),
-              desc="batch_reader") as pbar:
-        inputreads = _open_inputfile(inputfile, args.mode, threads=threads)
+    # stream the reads in one pass, no extra pass over the whole file to count reads
+    readnum = _get_readnum_from_index(inputreads)
+    batchnum = None if readnum is None else -(-readnum // args.holes_batch)
+    with tqdm(total=batchnum, desc="batch_reader") as pbar:
         all_reads = inputreads.fetch(until_eof=True)
-        count = 0
         count_batch = 0
         holebatchtmp = []
         for readitem in all_reads:
             readinfo_dict = readitem.to_dict()
             holebatchtmp.append(readinfo_dict)
-            count += 1
-            if count % args.holes_batch == 0 or count == totalnum:
+            if len(holebatchtmp) == args.holes_batch:
                 holebatch_q.put(holebatchtmp)
                 pbar.update(1)
                 count_batch += 1
                 holebatchtmp = []
-                # while holebatch_q.qsize() > queue_size_border:
-                while holebatch_q.qsize() > (args.threads if args.threads > 1 else 2) * 3:
-                    time.sleep(time_wait)
         inputreads.close()
-        if count_batch != len(holebatches):
-            LOGGER.warning("read {} batches while it should be {} batches!".format(count_batch,
-                                                                                   len(holebatches)))
         if len(holebatchtmp) > 0:
-            LOGGER.warning("There are still holes/reads that do not belong any batches!")
+            holebatch_q.put(holebatchtmp)
+            pbar.update(1)
+            count_batch += 1
+    LOGGER.info("split_holebatches process-{} generates {} "
+                "hole/read batches({})".format(os.getpid(), count_batch, args.holes_batch))
     holebatch_q.put("kill")
     LOGGER.info("split_holebatches process-{} finished".format(os.getpid()))
 
 
 # extract features =============================================
-def _normalize_signals(signals, normalize_method="zscore"):
+def _parse_bool_args(args):
+    """
+    parse the yes/no str args used in per-read extraction once, instead of in every read/site
+    :param args: argparse.Namespace
+    :return:
+    """
+    args.is_map_b = str2bool(args.is_map)
+    args.is_sn_b = str2bool(args.is_sn)
+    args.skip_unmapped_b = str2bool(args.skip_unmapped)
+
+
+def _normalize_signals(signals, normalize_method="zscore", out=None):
+    """
+    normalize signals of a read, results are written into out (float64) if provided
+    :param signals: np.ndarray
+    :param normalize_method: zscore, min-max, min-mean, mad, or none
+    :param out: pre-allocated np.float64 buffer with len(signals), or None
+    :return: normalized signals, rounded to 6 decimals; the int signals (frames/codes) as they are if none
+    """
     if normalize_method == 'none':
         # sshift, sscale = 0.0, 1.0
-        return np.around(signals, decimals=6)
+        return np.asarray(signals, dtype=np.int64)
+    if out is None:
+        out = np.empty(len(signals), dtype=np.float64)
     elif normalize_method == 'zscore':
-        sshift, sscale = np.mean(signals), np.std(signals)
+        sshift, sscale = signals.mean(dtype=np.float64), signals.std(dtype=np.float64)
     elif normalize_method == 'min-max':
-        sshift, sscale = np.min(signals), np.max(signals) - np.min(signals)
+        sshift = signals.min()
+        sscale = signals.max() - sshift
     elif normalize_method == 'min-mean':
-        sshift, sscale = np.min(signals), np.mean(signals)
+        sshift, sscale = signals.min(), signals.mean(dtype=np.float64)
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), float(robust.scale.mad(signals))
+        sshift = np.median(signals)
+        sscale = np.median(np.abs(signals - sshift)) / MAD_GAUSSIAN_CONST
     else:
         raise ValueError("")
     if sscale == 0.0:
-        norm_signals = [0.] * len(signals)
-    else:
-        norm_signals = (signals - sshift) / sscale
-    return np.around(norm_signals, decimals=6)
+        out.fill(0.)
+        return out
+    np.subtract(signals, sshift, out=out, casting="unsafe")
+    np.divide(out, sscale, out=out, casting="unsafe")
+    return np.round(out, 6, out=out)
+
+
+def _decode_and_zscore(codes, lut, out=None):
+    """
+    decode codes by lut and zscore the decoded signals, same as _normalize_signals(lut[codes], "zscore"),
+    mean/std are got from the code histogram, so the decoded signals are only walked to be shifted/scaled
+    :param codes: np.ndarray of uint8 codes
+    :param lut: code -> frame value, np.float64
+    :param out: pre-allocated np.float64 buffer with len(codes), or None
+    :return: normalized signals, rounded to 6 decimals
+    """
+    if out is None:
+        out = np.empty(len(codes), dtype=np.float64)
+    np.take(lut, codes, out=out)
+    code_cnts = np.bincount(codes, minlength=len(lut))
+    sshift = np.dot(code_cnts, lut) / len(codes)
+    svar = np.dot(code_cnts, lut * lut) / len(codes) - sshift * sshift
+    sscale = np.sqrt(svar) if svar > 0 else 0.0
+    if sscale == 0.0:
+        out.fill(0.)
+        return out
+    np.subtract(out, sshift, out=out, casting="unsafe")
+    np.divide(out, sscale, out=out, casting="unsafe")
+    return np.round(out, 6, out=out)
 
 
 def _get_q2t_mapinfo(q2t_loc, q_seq, t_seq):
     assert len(q2t_loc) == len(q_seq) + 1
     q2t_map = np.full(len(q2t_loc), 0, dtype=np.int32)
 
-    if q2t_loc[0] == -1:  # insertion 000/001
-        q2t_map[0] = 1
-    elif q_seq[0].upper() != t_seq[q2t_loc[0]].upper():  # mismatch 000/100
-        q2t_map[0] = 4
-
-    if len(q2t_loc) > 2:
-        for idx in range(1, len(q2t_loc)-1):
-            if q2t_loc[idx] == -1:  # insertion 000/001
-                q2t_map[idx] = 1
-            else:
-                if q_seq[idx].upper() != t_seq[q2t_loc[idx]].upper():  # mismatch 000/100
-                    q2t_map[idx] += 4
-                if q2t_loc[idx-1] != -1 and q2t_loc[idx] != q2t_loc[idx-1] + 1:  # deletion 000/010
-                    q2t_map[idx] += 2
+    # & 0xDF: to upper case
+    q_bases = np.frombuffer(q_seq.encode(), dtype=np.uint8) & 0xDF
+    t_bases = np.frombuffer(t_seq.encode(), dtype=np.uint8) & 0xDF
+    q_locs = q2t_loc[:-1]
+    is_ins = q_locs == -1
+    is_aln = ~is_ins
+    is_mis = is_aln & (t_bases[np.where(is_aln, q_locs, 0)] != q_bases)
+    is_del = np.zeros(len(q_locs), dtype=bool)
+    is_del[1:] = is_aln[1:] & is_aln[:-1] & (q_locs[1:] != q_locs[:-1] + 1)
+    # insertion 000/001, deletion 000/010, mismatch 000/100
+    q2t_map[:-1] = is_ins | (is_del.astype(np.int32) << 1) | (is_mis.astype(np.int32) << 2)
     return q2t_map
 
 
-def _get_fr_kmer_mapinfo(offset_idx, offset_revidx, num_bases, q_to_r_mapinfo):
-    q_to_r_mapinfo_s = q_to_r_mapinfo[:-1]  # ori len of q_to_r_mapinfo = len(seq_seq) + 1
+def _pad_q2t_mapinfo(q_to_r_mapinfo, pad_len):
+    """
+    pad q_to_r_mapinfo once per read, so that kmer mapinfo can be sliced without per-site padding
+    :param q_to_r_mapinfo: ori len of q_to_r_mapinfo = len(seq_seq) + 1
+    :param pad_len: should be >= num_bases + |offset between loc and rev_loc|
+    """
+    return np.pad(q_to_r_mapinfo[:-1], pad_len, mode='constant', constant_values=1)
 
-    if offset_idx - num_bases >= 0:
-        offset_s = offset_idx - num_bases
-        pad_l = 0
-    else:
-        offset_s = 0
-        pad_l = num_bases - offset_idx
-    if offset_idx + num_bases < len(q_to_r_mapinfo_s):
-        offset_e = offset_idx + num_bases + 1
-        pad_r = 0
-    else:
-        offset_e = len(q_to_r_mapinfo_s)
-        pad_r = num_bases + 1 - (len(q_to_r_mapinfo_s) - offset_idx)
-    fkmer_map = np.pad(q_to_r_mapinfo_s[offset_s:offset_e],
-                       (pad_l, pad_r),
-                       mode='constant', constant_values=1)
-
-    if offset_revidx - num_bases >= 0:
-        offset_s = offset_revidx - num_bases
-        pad_l = 0
-    else:
-        offset_s = 0
-        pad_l = num_bases - offset_revidx
-    if offset_revidx + num_bases < len(q_to_r_mapinfo_s):
-        offset_e = offset_revidx + num_bases + 1
-        pad_r = 0
-    else:
-        offset_e = len(q_to_r_mapinfo_s)
-        pad_r = num_bases + 1 - (len(q_to_r_mapinfo_s) - offset_revidx)
-    rkmer_map = np.flip(np.pad(q_to_r_mapinfo_s[offset_s:offset_e],
-                               (pad_l, pad_r),
-                               mode='constant', constant_values=1))
 
+def _get_fr_kmer_mapinfo(offset_idx, offset_revidx, num_bases, q_to_r_mapinfo_pad, pad_len):
+    """
+    :param q_to_r_mapinfo_pad: output of _pad_q2t_mapinfo()
+    :return: views of q_to_r_mapinfo_pad
+    """
+    kmer_len = 2 * num_bases + 1
+    offset_s = offset_idx - num_bases + pad_len
+    fkmer_map = q_to_r_mapinfo_pad[offset_s:(offset_s + kmer_len)]
+    offset_s = offset_revidx - num_bases + pad_len
+    rkmer_map = q_to_r_mapinfo_pad[offset_s:(offset_s + kmer_len)][::-1]
     return fkmer_map, rkmer_map
 
 
 def extract_features_from_double_strand_read(alignedsegment_tmp, motifs, holeids_e, holeids_ne, dnacontigs,
-                                             args):
+                                             args, feature_list):
+    """
+    extract features of the targeted sites in a read, and append them to feature_list
+    :return: True if any feature of this read is appended, else False
+    """
     seq_name, qalign_start, qalign_end, fwd_seq, _, ref_name, ref_start, ref_end, \
         cigar_tuples, cigar_stats, _, mapq, is_unmapped, is_secondary, is_duplicate, is_supplementary, \
         is_reverse, tag_fi, tag_ri, tag_fp, tag_rp, tag_fn, tag_rn, tag_sn \
         = _get_necessary_items_of_a_alignedsegment(alignedsegment_tmp)
 
     if holeids_e is not None and seq_name not in holeids_e:
-        return []
+        return False
     if holeids_ne is not None and seq_name in holeids_ne:
-        return []
+        return False
     if args.mode == "align":
         if is_unmapped or is_secondary or is_duplicate:
             LOGGER.debug("read-{} is unmapped/secondary/duplicate".format(seq_name))
-            return []
+            return False
         if args.no_supplementary and is_supplementary:
             LOGGER.debug("read-{} is supplementary".format(seq_name))
-            return []
+            return False
         if mapq < args.mapq:
             LOGGER.debug("read-{} has low mapQ({})".format(seq_name, mapq))
-            return []
+            return False
         identity = compute_pct_identity(np.array(cigar_stats[0]))
         if identity < args.identity:
             LOGGER.debug("read-{} has low map identity({})".format(seq_name, identity))
-            return []
+            return False
 
     # extract features
     seq_seq = fwd_seq
-    seq_rc = complement_seq(seq_seq)
     # seq_qual = np.array(fwd_qual, dtype=int) if len(fwd_qual) > 0 else np.full(len(seq_seq), 0, dtype=np.int32)
     # LOGGER.debug("read-{} has no base quality".format(seq_name))
     # seq_qual = _normalize_signals(seq_qual, args.norm)
@@ -305,105 +365,135 @@ def extract_features_from_double_strand_read(alignedsegment_tmp, motifs, holeids
     if args.mode == "align":
         strand_code = -1 if reverse else 1
         q_to_r_poss = get_q2tloc_from_cigar(cigar_tuples, strand_code, (seq_end - seq_start))
-        if str2bool(args.is_map):
+        if args.is_map_b:
             refseq = dnacontigs[ref_name][ref_start:ref_end]
             if reverse:
                 refseq = complement_seq(refseq)
             q_to_r_mapinfo = _get_q2t_mapinfo(q_to_r_poss, seq_seq[seq_start:seq_end], refseq)
 
-    ipdmean_fwd = np.array(tag_fi, dtype=int)
+    ipdmean_fwd = tag_fi
     # ipdmean_rev = np.flip(np.array(tag_ri, dtype=int))
-    ipdmean_rev = np.array(tag_ri, dtype=int)  # no need to use np.filp to reverse
-    pwmean_fwd = np.array(tag_fp, dtype=int)
+    ipdmean_rev = tag_ri  # no need to use np.filp to reverse
+    pwmean_fwd = tag_fp
     # pwmean_rev = np.flip(np.array(tag_rp, dtype=int))
-    pwmean_rev = np.array(tag_rp, dtype=int)
+    pwmean_rev = tag_rp
     if len(ipdmean_fwd) != len(seq_seq) or len(pwmean_fwd) != len(seq_seq):
         LOGGER.debug("read-{} has no/uncomplated fwd ipd/pw values".format(seq_name))
-        return []
+        return False
     if len(ipdmean_rev) != len(seq_seq) or len(pwmean_rev) != len(seq_seq):
         LOGGER.debug("read-{} has no/uncomplated rev ipd/pw values".format(seq_name))
-        return []
-    if not args.no_decode:
-        ipdmean_fwd = np.array([code2frames[val] for val in ipdmean_fwd])
-        ipdmean_rev = np.array([code2frames[val] for val in ipdmean_rev])
-        pwmean_fwd = np.array([code2frames[val] for val in pwmean_fwd])
-        pwmean_rev = np.array([code2frames[val] for val in pwmean_rev])
-    ipdmean_fwd = _normalize_signals(ipdmean_fwd, args.norm)
-    ipdmean_rev = _normalize_signals(ipdmean_rev, args.norm)
-    pwmean_fwd = _normalize_signals(pwmean_fwd, args.norm)
-    pwmean_rev = _normalize_signals(pwmean_rev, args.norm)
+        return False
+    # normalized signals are written into scratch buffers, the kmers gathered from them below are copies
+    read_len = len(seq_seq)
+    ipdmean_fwd_buf = _get_scratch_buffer("ipdmean_fwd", read_len)
+    ipdmean_rev_buf = _get_scratch_buffer("ipdmean_rev", read_len)
+    pwmean_fwd_buf = _get_scratch_buffer("pwmean_fwd", read_len)
+    pwmean_rev_buf = _get_scratch_buffer("pwmean_rev", read_len)
+    if not args.no_decode and args.norm == "zscore":
+        ipdmean_fwd = _decode_and_zscore(ipdmean_fwd, CODE2FRAMES_LUT, out=ipdmean_fwd_buf)
+        ipdmean_rev = _decode_and_zscore(ipdmean_rev, CODE2FRAMES_LUT, out=ipdmean_rev_buf)
+        pwmean_fwd = _decode_and_zscore(pwmean_fwd, CODE2FRAMES_LUT, out=pwmean_fwd_buf)
+        pwmean_rev = _decode_and_zscore(pwmean_rev, CODE2FRAMES_LUT, out=pwmean_rev_buf)
+    else:
+        if not args.no_decode:
+            ipdmean_fwd = np.take(CODE2FRAMES_LUT, ipdmean_fwd, out=ipdmean_fwd_buf)
+            ipdmean_rev = np.take(CODE2FRAMES_LUT, ipdmean_rev, out=ipdmean_rev_buf)
+            pwmean_fwd = np.take(CODE2FRAMES_LUT, pwmean_fwd, out=pwmean_fwd_buf)
+            pwmean_rev = np.take(CODE2FRAMES_LUT, pwmean_rev, out=pwmean_rev_buf)
+        ipdmean_fwd = _normalize_signals(ipdmean_fwd, args.norm, out=ipdmean_fwd_buf)
+        ipdmean_rev = _normalize_signals(ipdmean_rev, args.norm, out=ipdmean_rev_buf)
+        pwmean_fwd = _normalize_signals(pwmean_fwd, args.norm, out=pwmean_fwd_buf)
+        pwmean_rev = _normalize_signals(pwmean_rev, args.norm, out=pwmean_rev_buf)
 
     npass_fwd = tag_fn
     npass_rev = tag_rn
 
-    snratio = np.around(np.array(tag_sn, dtype=float), decimals=6) if str2bool(args.is_sn) else None
+    # "{:g}": keep the precision of the sam text of the tag, whether the read was got from a bam directly or
+    # from AlignedSegment.to_dict(); float32: the value of the text as stored in the B:f tag
+    snratio = np.around(np.array(list(map("{:g}".format, tag_sn)), dtype=np.float32).astype(np.float64),
+                        decimals=6) if args.is_sn_b else None
 
     # WARN: motifs needs to be symmetric seq, like CG/GATC
     motif_len = len(motifs[0])
     rev_offset_loc = (motif_len - 1 - args.mod_loc) - args.mod_loc
-    tsite_locs = get_refloc_of_methysite_in_motif(seq_seq, set(motifs), args.mod_loc)
+    tsite_locs = np.array(get_refloc_of_methysite_in_motif_regex(seq_seq, args.motif_regex, args.mod_loc),
+                          dtype=np.int64)
     num_bases = (args.seq_len - 1) // 2
-    feature_list = []
-    for loc in tsite_locs:
+    rev_locs_in_rev = len(seq_seq) - 1 - (tsite_locs + rev_offset_loc)
+    is_kmer_inread = (tsite_locs >= num_bases) & (tsite_locs < len(seq_seq) - num_bases) & \
+                     (rev_locs_in_rev >= num_bases) & (rev_locs_in_rev < len(seq_seq) - num_bases)
+    tsite_locs = tsite_locs[is_kmer_inread]
+    if len(tsite_locs) == 0:
+        return False
+    rev_locs_in_rev = rev_locs_in_rev[is_kmer_inread]
+    if q_to_r_mapinfo is not None:
+        mapinfo_pad_len = num_bases + abs(rev_offset_loc)
+        q_to_r_mapinfo = _pad_q2t_mapinfo(q_to_r_mapinfo, mapinfo_pad_len)
+    # gather the kmers of all sites at once, (n_sites, seq_len) for each signal
+    fkmer_ims = sliding_window_view(ipdmean_fwd, args.seq_len)[tsite_locs - num_bases]
+    fkmer_pms = sliding_window_view(pwmean_fwd, args.seq_len)[tsite_locs - num_bases]
+    rkmer_ims = sliding_window_view(ipdmean_rev, args.seq_len)[rev_locs_in_rev - num_bases]
+    rkmer_pms = sliding_window_view(pwmean_rev, args.seq_len)[rev_locs_in_rev - num_bases]
+    num_features = len(feature_list)
+    for site_idx, loc in enumerate(tsite_locs.tolist()):
         rev_loc = loc + rev_offset_loc
-        rev_loc_in_rev = len(seq_seq) - 1 - rev_loc
-        if num_bases <= loc < len(seq_seq) - num_bases and num_bases <= rev_loc_in_rev < len(seq_seq) - num_bases:
-            fkmer_seq = seq_seq[(loc - num_bases):(loc + num_bases + 1)]
-            fkmer_im = ipdmean_fwd[(loc - num_bases):(loc + num_bases + 1)]
-            fkmer_isd = "."
-            fkmer_pm = pwmean_fwd[(loc - num_bases):(loc + num_bases + 1)]
-            fkmer_psd = "."
-            # fkmer_qual = seq_qual[(loc - num_bases):(loc + num_bases + 1)]
-            # fkmer_sn = np.array([snratio[SEQ_ENCODE[nbase]] for nbase in fkmer_seq], dtype=float) if str2bool(args.is_sn) else "."
-            fkmer_sn = snratio if str2bool(args.is_sn) else "."
-
-            rkmer_seq = seq_rc[(rev_loc_in_rev - num_bases):(rev_loc_in_rev + num_bases + 1)]
-            rkmer_im = ipdmean_rev[(rev_loc_in_rev - num_bases):(rev_loc_in_rev + num_bases + 1)]
-            rkmer_isd = "."
-            rkmer_pm = pwmean_rev[(rev_loc_in_rev - num_bases):(rev_loc_in_rev + num_bases + 1)]
-            rkmer_psd = "."
-            # rkmer_qual = np.flip(seq_qual[(rev_loc - num_bases):(rev_loc + num_bases + 1)])
-            # rkmer_sn = np.array([snratio[SEQ_ENCODE[nbase]] for nbase in rkmer_seq], dtype=float) if str2bool(args.is_sn) else "."
-            rkmer_sn = snratio if str2bool(args.is_sn) else "."
-
-            if q_to_r_poss is not None:
-                chrom = ref_name
-                chrom_pos = default_ref_loc
-                strand = "-" if reverse else "+"
-                fkmer_map = "."
-                rkmer_map = "."
-
-                if seq_start <= loc < seq_end:
-                    offset_idx = loc - seq_start
-                    offset_revidx = rev_loc - seq_start
-                    if q_to_r_poss[offset_idx] != -1:
-                        if reverse:
-                            chrom_pos = ref_end - 1 - q_to_r_poss[offset_idx]
-                        else:
-                            chrom_pos = q_to_r_poss[offset_idx] + ref_start
-
-                    if str2bool(args.is_map):
-                        fkmer_map, rkmer_map = _get_fr_kmer_mapinfo(offset_idx, offset_revidx, num_bases,
-                                                                    q_to_r_mapinfo)
-                else:
-                    if str2bool(args.skip_unmapped):  # skip soft clip region
-                        continue
-                    if str2bool(args.is_map):
-                        fkmer_map = np.full(args.seq_len, 1, dtype=np.int32)
-                        rkmer_map = np.full(args.seq_len, 1, dtype=np.int32)
+        fkmer_seq = seq_seq[(loc - num_bases):(loc + num_bases + 1)]
+        fkmer_im = fkmer_ims[site_idx]
+        fkmer_isd = "."
+        fkmer_pm = fkmer_pms[site_idx]
+        fkmer_psd = "."
+        # fkmer_qual = seq_qual[(loc - num_bases):(loc + num_bases + 1)]
+        # fkmer_sn = np.array([snratio[SEQ_ENCODE[nbase]] for nbase in fkmer_seq], dtype=float) if str2bool(args.is_sn) else "."
+        fkmer_sn = snratio if args.is_sn_b else "."
+
+        # reverse complement only the kmer around rev_loc, instead of the whole read
+        rkmer_seq = complement_seq(seq_seq[(rev_loc - num_bases):(rev_loc + num_bases + 1)])
+        rkmer_im = rkmer_ims[site_idx]
+        rkmer_isd = "."
+        rkmer_pm = rkmer_pms[site_idx]
+        rkmer_psd = "."
+        # rkmer_qual = np.flip(seq_qual[(rev_loc - num_bases):(rev_loc + num_bases + 1)])
+        # rkmer_sn = np.array([snratio[SEQ_ENCODE[nbase]] for nbase in rkmer_seq], dtype=float) if str2bool(args.is_sn) else "."
+        rkmer_sn = snratio if args.is_sn_b else "."
+
+        if q_to_r_poss is not None:
+            chrom = ref_name
+            chrom_pos = default_ref_loc
+            strand = "-" if reverse else "+"
+            fkmer_map = "."
+            rkmer_map = "."
+
+            if seq_start <= loc < seq_end:
+                offset_idx = loc - seq_start
+                offset_revidx = rev_loc - seq_start
+                if q_to_r_poss[offset_idx] != -1:
+                    if reverse:
+                        chrom_pos = ref_end - 1 - q_to_r_poss[offset_idx]
+                    else:
+                        chrom_pos = q_to_r_poss[offset_idx] + ref_start
+
+                if args.is_map_b:
+                    fkmer_map, rkmer_map = _get_fr_kmer_mapinfo(offset_idx, offset_revidx, num_bases,
+                                                                q_to_r_mapinfo, mapinfo_pad_len)
             else:
-                chrom = "."
-                chrom_pos = default_ref_loc
-                strand = "."
-                fkmer_map = "."
-                rkmer_map = "."
-            feature_list.append([chrom, chrom_pos, strand, seq_name, loc,
-                                 fkmer_seq, npass_fwd, fkmer_im, fkmer_isd, fkmer_pm, fkmer_psd,
-                                 fkmer_sn, fkmer_map,
-                                 rkmer_seq, npass_rev, rkmer_im, rkmer_isd, rkmer_pm, rkmer_psd,
-                                 rkmer_sn, rkmer_map,
-                                 args.methy_label])
-    return feature_list
+                if args.skip_unmapped_b:  # skip soft clip region
+                    continue
+                if args.is_map_b:
+                    fkmer_map = np.full(args.seq_len, 1, dtype=np.int32)
+                    rkmer_map = np.full(args.seq_len, 1, dtype=np.int32)
+        else:
+            chrom = "."
+            chrom_pos = default_ref_loc
+            strand = "."
+            fkmer_map = "."
+            rkmer_map = "."
+        feature_list.append([chrom, chrom_pos, strand, seq_name, loc,
+                             fkmer_seq, npass_fwd, fkmer_im, fkmer_isd, fkmer_pm, fkmer_psd,
+                             fkmer_sn, fkmer_map,
+                             rkmer_seq, npass_rev, rkmer_im, rkmer_isd, rkmer_pm, rkmer_psd,
+                             rkmer_sn, rkmer_map,
+                             args.methy_label])
+    return len(feature_list) > num_features
 
 
 def process_one_holebatch(input_header, holebatch, motifs, holeids_e, holeids_ne, dnacontigs, args):
@@ -413,29 +503,47 @@ def process_one_holebatch(input_header, holebatch, motifs, holeids_e, holeids_ne
     holeidxes = []
 
     for read_idx, readinfo in enumerate(holebatch):
+        num_features = len(feature_list)
         try:
-            alignedsegment_tmp = pysam.AlignedSegment.from_dict(readinfo, input_header)  # not necessary?
-            features_one = extract_features_from_double_strand_read(alignedsegment_tmp,
-                                                                    motifs, holeids_e, holeids_ne,
-                                                                    dnacontigs,
-                                                                    args)
-            if len(features_one) == 0:
-                failed_num += 1
+            if isinstance(readinfo, pysam.AlignedSegment):
+                alignedsegment_tmp = readinfo
+            else:
+                alignedsegment_tmp = pysam.AlignedSegment.from_dict(readinfo, input_header)  # not necessary?
+            if extract_features_from_double_strand_read(alignedsegment_tmp,
+                                                        motifs, holeids_e, holeids_ne,
+                                                        dnacontigs,
+                                                        args, feature_list):
+                holeidxes.extend([read_idx] * (len(feature_list) - num_features))
             else:
-                feature_list += features_one
-                holeidxes += [read_idx] * len(features_one)
+                failed_num += 1
         except Exception as e:
-            LOGGER.warning("{}: {} in read:{}".format(type(e).__name__, e, readinfo['name']))
+            read_name = readinfo.query_name if isinstance(readinfo, pysam.AlignedSegment) else readinfo['name']
+            LOGGER.warning("{}: {} in read:{}".format(type(e).__name__, e, read_name))
+            # drop the features appended before the exception
+            del feature_list[num_features:]
             failed_num += 1
         total_num += 1
     return holeidxes, feature_list, total_num, failed_num
 
 
+def _kmer_feature2str(kmer_feature):
+    """
+    join the values of a kmer feature by comma, "." is kept as it is
+    :param kmer_feature: np.ndarray or "."
+    :return: str
+    """
+    if type(kmer_feature) is str:
+        return "."
+    # tolist() converts to python scalars in C, map() avoids a python-level loop.
+    # floats are float64 rounded to 6 decimals, str() gives their shortest text, e.g., 7.55
+    return ",".join(map(str, kmer_feature.tolist()))
+
+
 def _features_to_str(features, ss=False):
     """
 
     :param features: a tuple
-    :return:
+    :return: bytes of a feature line (without line break), encoded once for the binary writer
     """
     chrom, chrom_pos, strand, seq_name, loc, \
         fkmer_seq, npass_fwd, fkmer_im, fkmer_isd, fkmer_pm, fkmer_psd, \
@@ -444,26 +552,14 @@ def _features_to_str(features, ss=False):
         rkmer_sn, rkmer_map, \
         label = features
 
-    fkmer_im_str = ",".join([str(x) for x in fkmer_im])
-    fkmer_isd_str = ",".join([str(x) for x in fkmer_isd]) if type(fkmer_isd) is not str else "."
-    fkmer_pm_str = ",".join([str(x) for x in fkmer_pm])
-    fkmer_psd_str = ",".join([str(x) for x in fkmer_psd]) if type(fkmer_psd) is not str else "."
-    fkmer_sn_str = ",".join([str(x) for x in fkmer_sn]) if type(fkmer_sn) is not str else "."
-    fkmer_map_str = ",".join([str(x) for x in fkmer_map]) if type(fkmer_map) is not str else "."
-
-    rkmer_im_str = ",".join([str(x) for x in rkmer_im])
-    rkmer_isd_str = ",".join([str(x) for x in rkmer_isd]) if type(rkmer_isd) is not str else "."
-    rkmer_pm_str = ",".join([str(x) for x in rkmer_pm])
-    rkmer_psd_str = ",".join([str(x) for x in rkmer_psd]) if type(rkmer_psd) is not str else "."
-    rkmer_sn_str = ",".join([str(x) for x in rkmer_sn]) if type(rkmer_sn) is not str else "."
-    rkmer_map_str = ",".join([str(x) for x in rkmer_map]) if type(rkmer_map) is not str else "."
-
     return "\t".join([chrom, str(chrom_pos), strand, seq_name, str(loc),
-                      fkmer_seq, str(npass_fwd), fkmer_im_str, fkmer_isd_str, fkmer_pm_str, fkmer_psd_str,
-                      fkmer_sn_str, fkmer_map_str,
-                      rkmer_seq, str(npass_rev), rkmer_im_str, rkmer_isd_str, rkmer_pm_str, rkmer_psd_str,
-                      rkmer_sn_str, rkmer_map_str,
-                      str(label)])
+                      fkmer_seq, str(npass_fwd), _kmer_feature2str(fkmer_im), _kmer_feature2str(fkmer_isd),
+                      _kmer_feature2str(fkmer_pm), _kmer_feature2str(fkmer_psd),
+                      _kmer_feature2str(fkmer_sn), _kmer_feature2str(fkmer_map),
+                      rkmer_seq, str(npass_rev), _kmer_feature2str(rkmer_im), _kmer_feature2str(rkmer_isd),
+                      _kmer_feature2str(rkmer_pm), _kmer_feature2str(rkmer_psd),
+                      _kmer_feature2str(rkmer_sn), _kmer_feature2str(rkmer_map),
+                      str(label)]).encode()
 
 
 def worker_extract_features_from_holebatches(input_header, holebatch_q, features_q,
@@ -474,14 +570,16 @@ def worker_extract_features_from_holebatches(input_header, holebatch_q, features
         input_header2 = pysam.AlignmentHeader.from_dict(input_header)
     else:
         input_header2 = input_header
-    
+    _parse_bool_args(args)
+    args.motif_regex = compile_motif_regex(motifs)
+
     cnt_holesbatch = 0
     total_num_batch, failed_num_batch = 0, 0
     while True:
-        if holebatch_q.empty():
-            time.sleep(time_wait)
+        try:
+            holebatch = holebatch_q.get(timeout=time_wait)
+        except queue.Empty:
             continue
-        holebatch = holebatch_q.get()
         if holebatch == "kill":
             holebatch_q.put("kill")
             break
@@ -498,9 +596,6 @@ def worker_extract_features_from_holebatches(input_header, holebatch_q, features
             for feature in feature_list:
                 features_batch.append(_features_to_str(feature))
             features_q.put(features_batch)
-            # while features_q.qsize() > queue_size_border:
-            while features_q.qsize() > (args.threads if args.threads > 1 else 2) * 3:
-                time.sleep(time_wait)
         cnt_holesbatch += 1
     LOGGER.info("extract_features process-{} ending, proceed {} "
                 "hole_batches({}): {} holes/reads in total, "
@@ -511,28 +606,107 @@ def worker_extract_features_from_holebatches(input_header, holebatch_q, features
                                             failed_num_batch))
 
 
+def _split_regions_by_index(inputfile, nbins, npieces_per_bin=4):
+    """
+    split the contigs of an indexed bam into regions, and the regions into at most nbins bins with similar
+    numbers of mapped reads (by index statistics, assuming reads are evenly distributed in a contig)
+    :return: list of region (contig, start, end) lists, or None if the index statistics are not available
+    """
+    try:
+        with pysam.AlignmentFile(inputfile, 'rb') as inputreads:
+            contig_stats = [(stat.contig, inputreads.get_reference_length(stat.contig), stat.mapped)
+                            for stat in inputreads.get_index_statistics() if stat.mapped > 0]
+    except (ValueError, AttributeError):
+        return None
+    nbins = max(1, nbins)
+    mapped_per_piece = max(1, sum([x[2] for x in contig_stats]) // (nbins * npieces_per_bin))
+    regions = []
+    for contig, contig_len, mapped in contig_stats:
+        npieces = max(1, mapped // mapped_per_piece)
+        piece_len = -(-contig_len // npieces)
+        for start in range(0, contig_len, piece_len):
+            regions.append((contig, start, min(start + piece_len, contig_len), mapped / npieces))
+    # greedy: the next largest region goes to the least loaded bin
+    region_bins = [[] for _ in range(nbins)]
+    bin_loads = [0] * nbins
+    for contig, start, end, mapped in sorted(regions, key=lambda x: x[3], reverse=True):
+        bin_idx = bin_loads.index(min(bin_loads))
+        region_bins[bin_idx].append((contig, start, end))
+        bin_loads[bin_idx] += mapped
+    return [region_bin for region_bin in region_bins if len(region_bin) > 0]
+
+
+def worker_extract_features_from_regions(inputfile, regions, features_q,
+                                         motifs, holeids_e, holeids_ne, dnacontigs, args):
+    """
+    read the reads of regions from an indexed bam by itself, no reading process/holebatch queue needed.
+    a read belongs to the region its reference_start is in, so reads are not handled twice
+    """
+    LOGGER.info("extract_features process-{} starts, {} regions".format(os.getpid(), len(regions)))
+    _parse_bool_args(args)
+    args.motif_regex = compile_motif_regex(motifs)
+
+    inputreads = pysam.AlignmentFile(inputfile, 'rb')
+
+    def _handle_one_holebatch(holebatch):
+        _, feature_list, total_num, failed_num = process_one_holebatch(inputreads.header, holebatch,
+                                                                       motifs, holeids_e, holeids_ne,
+                                                                       dnacontigs,
+                                                                       args)
+        if len(feature_list) > 0:
+            features_q.put([_features_to_str(feature) for feature in feature_list])
+        return total_num, failed_num
+
+    cnt_holesbatch = 0
+    total_num_batch, failed_num_batch = 0, 0
+    holebatch = []
+    for contig, start, end in regions:
+        for readitem in inputreads.fetch(contig, start, end):
+            if readitem.reference_start < start:
+                continue
+            holebatch.append(readitem)
+            if len(holebatch) == args.holes_batch:
+                total_num, failed_num = _handle_one_holebatch(holebatch)
+                total_num_batch += total_num
+                failed_num_batch += failed_num
+                cnt_holesbatch += 1
+                holebatch = []
+    if len(holebatch) > 0:
+        total_num, failed_num = _handle_one_holebatch(holebatch)
+        total_num_batch += total_num
+        failed_num_batch += failed_num
+        cnt_holesbatch += 1
+    inputreads.close()
+    LOGGER.info("extract_features process-{} ending, proceed {} "
+                "hole_batches({}): {} holes/reads in total, "
+                "{} skipped/failed.".format(os.getpid(),
+                                            cnt_holesbatch,
+                                            args.holes_batch,
+                                            total_num_batch,
+                                            failed_num_batch))
+
+
 # write to file =============================================
 def _write_featurestr_to_file(write_fp, featurestr_q, is_gzip):
     LOGGER.info('write_process-{} starts'.format(os.getpid()))
     if is_gzip:
         if not write_fp.endswith(".gz"):
             write_fp += ".gz"
-        wf = gzip.open(write_fp, "wt")
+        wf = gzip.open(write_fp, "wb")
     else:
-        wf = open(write_fp, 'w')
+        wf = open(write_fp, 'wb')
     while True:
-        # during test, it's ok without the sleep(time_wait)
-        if featurestr_q.empty():
-            time.sleep(time_wait)
+        try:
+            features_str = featurestr_q.get(timeout=time_wait)
+        except queue.Empty:
             continue
-        features_str = featurestr_q.get()
         if features_str == "kill":
             wf.close()
             LOGGER.info('write_process-{} finished'.format(os.getpid()))
             break
-        for one_features_str in features_str:
-            wf.write(one_features_str + "\n")
-        wf.flush()
+        if len(features_str) > 0:
+            # one write per batch, no flush, let the file/gzip buffer work
+            wf.write(b"\n".join(features_str) + b"\n")
 
 
 def extract_hifireads_features(args):
@@ -562,8 +736,56 @@ def extract_hifireads_features(args):
     holeids_ne = None if args.holeids_ne is None else _get_holes(args.holeids_ne)
     motifs = get_motif_seqs(args.motifs)
 
-    holebatch_q = Queue()
-    features_q = Queue()
+    # bounded queues, put() blocks when consumers fall behind
+    queue_size_border = (args.threads if args.threads > 1 else 2) * 3
+
+    # aligned+indexed bam: each extracting process fetches the reads of its own regions, no reading process
+    region_bins = None
+    if args.mode == "align" and inputpath.endswith(".bam"):
+        region_bins = _split_regions_by_index(inputpath, args.threads - 1 if args.threads > 1 else 1)
+    if region_bins is not None:
+        features_q = Queue(maxsize=queue_size_border)
+        ps_extract = []
+        for regions in region_bins:
+            p = mp.Process(target=worker_extract_features_from_regions,
+                           args=(inputpath, regions, features_q, motifs, holeids_e, holeids_ne, dnacontigs, args))
+            p.daemon = True
+            p.start()
+            ps_extract.append(p)
+
+        p_w = mp.Process(target=_write_featurestr_to_file, args=(outputpath, features_q, args.gzip))
+        p_w.daemon = True
+        p_w.start()
+
+        for p in ps_extract:
+            p.join()
+        features_q.put("kill")
+        p_w.join()
+
+        # a dead process drops all the remaining reads of its regions
+        failed_pids = [str(p.pid) for p in ps_extract if p.exitcode != 0]
+        if len(failed_pids) > 0:
+            LOGGER.error("extract_features process-{} failed, {} is incomplete".format(",".join(failed_pids),
+                                                                                        outputpath))
+            raise RuntimeError("extract_features processes failed")
+
+        endtime = time.time()
+        LOGGER.info("[main]extract_features_hifi costs {:.1f} seconds".format(endtime - start))
+        return
+
+    holebatch_q = None
+    if args.use_shm:
+        shm_bytes = queue_size_border * args.holes_batch * shm_bytes_per_read
+        shm_free = get_shm_free_bytes()
+        if shm_free is not None and shm_bytes > shm_free:
+            # writing to a full /dev/shm kills the process by SIGBUS
+            LOGGER.warning("--use_shm needs {:.1f}MB but only {:.1f}MB free in /dev/shm, "
+                           "use pipes instead".format(shm_bytes / 1024 ** 2, shm_free / 1024 ** 2))
+        else:
+            holebatch_q = SharedMemoryQueue(queue_size_border, args.holes_batch * shm_bytes_per_read)
+    if holebatch_q is None:
+        holebatch_q = Queue(maxsize=queue_size_border)
+    features_q = Queue(maxsize=queue_size_border)
 
     inputreads = _open_inputfile(inputpath, args.mode, threads=args.threads)
     input_header = inputreads.header
@@ -591,12 +813,6 @@ def extract_hifireads_features(args):
     p_w.daemon = True
     p_w.start()
 
-    while True:
-        # print("killing _worker_extract process")
-        running = any(p.is_alive() for p in ps_extract)
-        if not running:
-            break
-
     for p in ps_extract:
         p.join()
     p_split.join()
@@ -604,6 +820,10 @@ def extract_hifireads_features(args):
     features_q.put("kill")
     p_w.join()
 
+    if isinstance(holebatch_q, SharedMemoryQueue):
+        holebatch_q.close()
+        holebatch_q.unlink()
+
     endtime = time.time()
     LOGGER.info("[main]extract_features_hifi costs {:.1f} seconds".format(endtime - start))
 
@@ -663,6 +883,9 @@ def main():
     #                             "the PATH.")
     p_extract.add_argument("--holes_batch", type=int, default=50, required=False,
                            help="number of holes/hifi-reads in an batch to get/put in queues, default 50")
+    p_extract.add_argument("--use_shm", action="store_true", default=False, required=False,
+                           help="[EXPERIMENTAL]pass hole/read batches to the extracting processes through "
+                                "shared memory instead of pipes, needs enough space in /dev/shm")
     p_extract.add_argument("--is_sn", type=str, default="no", required=False,
                            help="if extracting signal-to-noise features, yes or no, default no")
     p_extract.add_argument("--is_map", type=str, default="no", required=False,
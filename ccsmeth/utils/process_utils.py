@@ -103,19 +103,22 @@ def _alphabet(letter, dbasepairs):
     return 'N'
 
 
+def _complement_transtable(dbasepairs):
+    # same as _alphabet(): bases not in dbasepairs are complemented to 'N'
+    return str.maketrans(dict((chr(i), _alphabet(chr(i), dbasepairs)) for i in range(256)))
+
+
+COMPLEMENT_TRANS_DNA = _complement_transtable(basepairs)
+COMPLEMENT_TRANS_RNA = _complement_transtable(basepairs_rna)
+
+
 def complement_seq(base_seq, seq_type="DNA") -> str:
-    rbase_seq = base_seq[::-1]
-    comseq = ''
-    try:
-        if seq_type == "DNA":
-            comseq = ''.join([_alphabet(x, basepairs) for x in rbase_seq])
-        elif seq_type == "RNA":
-            comseq = ''.join([_alphabet(x, basepairs_rna) for x in rbase_seq])
-        else:
-            raise ValueError("the seq_type must be DNA or RNA")
-    except Exception:
-        LOGGER.warning('something wrong in the dna/rna sequence.')
-    return comseq
+    if seq_type == "DNA":
+        return base_seq.translate(COMPLEMENT_TRANS_DNA)[::-1]
+    elif seq_type == "RNA":
+        return base_seq.translate(COMPLEMENT_TRANS_RNA)[::-1]
+    else:
+        raise ValueError("the seq_type must be DNA or RNA")
 
 
 # motifs ======================================================================
@@ -137,6 +140,26 @@ def get_refloc_of_methysite_in_motif(seqstr, motifset, methyloc_in_motif=0) -> l
     return sites
 
 
+def compile_motif_regex(motifs):
+    """
+    compile motifs into one regex, the lookahead makes overlapping sites be found
+    :param motifs: motif seqs of the same length, output of get_motif_seqs()
+    :return: compiled regex, m.start() of each match in .finditer() is the motif start
+    """
+    return re.compile("(?=(" + "|".join(map(re.escape, motifs)) + "))")
+
+
+def get_refloc_of_methysite_in_motif_regex(seqstr, motif_regex, methyloc_in_motif=0) -> list:
+    """
+    same as get_refloc_of_methysite_in_motif(), but with one regex pass over seqstr
+    :param seqstr:
+    :param motif_regex: output of compile_motif_regex()
+    :param methyloc_in_motif: 0-based
+    :return:
+    """
+    return [m.start() + methyloc_in_motif for m in motif_regex.finditer(seqstr)]
+
+
 def _convert_motif_seq(ori_seq, is_dna=True):
     outbases = []
     for bbase in ori_seq:
@@ -199,27 +222,23 @@ def get_q2tloc_from_cigar(r_cigar_tuple, strand, seq_len):
     # get each base calls genomic position
     q_to_r_poss = np.full(seq_len + 1, fill_invalid, dtype=np.int32)
     # process cigar ops in read direction
-    curr_r_pos, curr_q_pos = 0, 0
     cigar_ops = r_cigar_tuple if strand == 1 else r_cigar_tuple[::-1]
-    for op, op_len in cigar_ops:
-        if op == 1:
-            # inserted bases into ref
-            for q_pos in range(curr_q_pos, curr_q_pos + op_len):
-                q_to_r_poss[q_pos] = -1
-            curr_q_pos += op_len
-        elif op in (2, 3):
-            # deleted ref bases
-            curr_r_pos += op_len
-        elif op in (0, 7, 8):
-            # aligned bases
-            for op_offset in range(op_len):
-                q_to_r_poss[curr_q_pos + op_offset] = curr_r_pos + op_offset
-            curr_q_pos += op_len
-            curr_r_pos += op_len
-        elif op == 6:
-            # padding (shouldn't happen in mappy)
-            pass
-    q_to_r_poss[curr_q_pos] = curr_r_pos
+    cigar_arr = np.array(cigar_ops, dtype=np.int64).reshape(-1, 2)
+    ops, op_lens = cigar_arr[:, 0], cigar_arr[:, 1]
+    # inserted bases into ref: 1; deleted ref bases: 2, 3; aligned bases: 0, 7, 8;
+    # padding (6, shouldn't happen in mappy) and clips are skipped
+    is_ins = ops == 1
+    is_aln = (ops == 0) | (ops == 7) | (ops == 8)
+    q_lens = np.where(is_ins | is_aln, op_lens, 0)
+    r_lens = np.where(is_aln | (ops == 2) | (ops == 3), op_lens, 0)
+    curr_q_pos, curr_r_pos = int(q_lens.sum()), int(r_lens.sum())
+    if curr_q_pos <= seq_len:
+        # each query base: ref start of its cigar op + its offset in the op, -1 for insertions
+        op_idxs = np.repeat(np.arange(len(ops)), q_lens)
+        op_offsets = np.arange(curr_q_pos) - np.repeat(np.cumsum(q_lens) - q_lens, q_lens)
+        r_starts = np.cumsum(r_lens) - r_lens
+        q_to_r_poss[:curr_q_pos] = np.where(is_ins[op_idxs], -1, r_starts[op_idxs] + op_offsets)
+        q_to_r_poss[curr_q_pos] = curr_r_pos
     if q_to_r_poss[-1] == fill_invalid:
         raise ValueError(('Invalid cigar string encountered. Reference length: {}  Cigar ' +
                           'implied reference length: {}').format(seq_len, curr_r_pos))
@@ -0,0 +1,68 @@
+import os
+import pickle
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+
+def get_shm_free_bytes(shm_dir="/dev/shm"):
+    """
+    :return: free bytes of shm_dir, None if it cannot be checked (e.g., no /dev/shm)
+    """
+    try:
+        shm_stat = os.statvfs(shm_dir)
+    except (OSError, AttributeError):
+        return None
+    return shm_stat.f_bavail * shm_stat.f_frsize
+
+
+class SharedMemoryQueue(object):
+    """
+    A multiprocessing.Queue-like queue for big batches. Each item is pickled once into a
+    free slot of a shared memory ring, only the (slot, nbytes) pair goes through the pipe.
+    Items larger than a slot fall back to being sent through the pipe.
+    Pages of the shared memory are only allocated when written, but all slots may be written when
+    consumers fall behind, so the whole size should fit in /dev/shm (see get_shm_free_bytes()).
+    """
+    def __init__(self, maxsize, slot_size):
+        self._nslots = max(1, maxsize)
+        self._slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=self._nslots * slot_size)
+        self._free_slots = mp.Queue()
+        for slot in range(self._nslots):
+            self._free_slots.put(slot)
+        self._items = mp.Queue(maxsize=self._nslots)
+
+    def put(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self._slot_size:
+            self._items.put((-1, data))
+            return
+        # blocks until a consumer releases a slot
+        slot = self._free_slots.get()
+        offset = slot * self._slot_size
+        self._shm.buf[offset:(offset + len(data))] = data
+        self._items.put((slot, len(data)))
+
+    def get(self, block=True, timeout=None):
+        """
+        :raise queue.Empty: as multiprocessing.Queue.get()
+        """
+        slot, data = self._items.get(block, timeout)
+        if slot < 0:
+            return pickle.loads(data)
+        offset = slot * self._slot_size
+        obj = pickle.loads(self._shm.buf[offset:(offset + data)])
+        self._free_slots.put(slot)
+        return obj
+
+    def qsize(self):
+        return self._items.qsize()
+
+    def empty(self):
+        return self._items.empty()
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
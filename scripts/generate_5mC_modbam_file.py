@@ -1,52 +1,36 @@
 import os
 import argparse
 import pysam
-import re
-import math
+import array
 import sys
 import time
 import tabix
+import numpy as np
 
 import multiprocessing as mp
 from multiprocessing import Queue
 
 from generate_per_read_modscall import _generate_sorted_per_read_calls
 
+try:
+    # --use_shm needs the installed ccsmeth package, one implementation for ccsmeth and this script
+    from ccsmeth.utils.shared_memory_queue import SharedMemoryQueue
+    from ccsmeth.utils.shared_memory_queue import get_shm_free_bytes
+except ImportError:
+    SharedMemoryQueue = None
+
 base = "C"
 pred_base = "CG"
 
 queue_size_border = 1000
-time_wait = 1
+# pickled size of one read in a batch, used to size slots of --use_shm. a hifi read with pulse tags takes
+# ~14 bytes per base (~200KB for a 15kb read), batches larger than a slot go through the pipe
+shm_bytes_per_read = 512 * 1024
 
 basepairs = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N',
              'W': 'W', 'S': 'S', 'M': 'K', 'K': 'M', 'R': 'Y',
              'Y': 'R', 'B': 'V', 'V': 'B', 'D': 'H', 'H': 'D',
              'Z': 'Z'}
-basepairs_rna = {'A': 'U', 'C': 'G', 'G': 'C', 'U': 'A', 'N': 'N',
-                 'W': 'W', 'S': 'S', 'M': 'K', 'K': 'M', 'R': 'Y',
-                 'Y': 'R', 'B': 'V', 'V': 'B', 'D': 'H', 'H': 'D',
-                 'Z': 'Z'}
-
-
-def _alphabet(letter, dbasepairs):
-    if letter in dbasepairs.keys():
-        return dbasepairs[letter]
-    return 'N'
-
-
-def complement_seq(base_seq, seq_type="DNA"):
-    rbase_seq = base_seq[::-1]
-    comseq = ''
-    try:
-        if seq_type == "DNA":
-            comseq = ''.join([_alphabet(x, basepairs) for x in rbase_seq])
-        elif seq_type == "RNA":
-            comseq = ''.join([_alphabet(x, basepairs_rna) for x in rbase_seq])
-        else:
-            raise ValueError("the seq_type must be DNA or RNA")
-    except Exception:
-        print('something wrong in the dna/rna sequence.')
-    return comseq
 
 
 def open_input_bamfile(bamfile, threads=1):
@@ -66,7 +50,8 @@ def _get_necessary_alignment_items(readitem):
     ref_name = readitem.reference_name
     ref_start = readitem.reference_start
     mapq = readitem.mapping_quality
-    cigartuples = readitem.cigartuples
+    # one string pickles much cheaper than a list of tuples
+    cigarstring = readitem.cigarstring
     rnext = readitem.next_reference_name
     pnext = readitem.next_reference_start
     tlen = readitem.template_length
@@ -74,7 +59,7 @@ def _get_necessary_alignment_items(readitem):
     seq_qual = readitem.query_qualities
     all_tags = readitem.get_tags(with_value_type=True)
     is_reverse = readitem.is_reverse
-    return (seq_name, flag, ref_name, ref_start, mapq, cigartuples,
+    return (seq_name, flag, ref_name, ref_start, mapq, cigarstring,
             rnext, pnext, tlen, seq_seq, seq_qual, all_tags, is_reverse)
 
 
@@ -89,45 +74,38 @@ def _worker_reader(bamfile, batch_size, rreads_q, threads=1):
         if cnt_all % batch_size == 0:
             rreads_q.put(reads_batch)
             reads_batch = []
-            while rreads_q.qsize() > queue_size_border:
-                time.sleep(time_wait)
     ori_bam.close()
     if len(reads_batch) > 0:
         rreads_q.put(reads_batch)
-    rreads_q.put("kill")
     sys.stderr.write("read {} reads from input file\n".format(cnt_all))
 
 
 def _convert_locstr(locstr):
-    return [int(x) for x in locstr.split(",")]
+    return np.fromstring(locstr, dtype=np.int64, sep=",")
 
 
 def _convert_probstr(probstr):
-    return [float(x) for x in probstr.split(",")]
+    return np.fromstring(probstr, dtype=np.float64, sep=",")
 
 
 def _fetch_locprobs_of_a_read_from_tabixobj2(readname, tabixobj):
     # pytabix is faster
     try:
         rows = tabixobj.query(readname, 0, 5000000)
-        row_list = []
-        for row in rows:
-            row_list.append(row)
-        if len(row_list) == 1:
-            return _convert_locstr(row_list[0][4]), _convert_probstr(row_list[0][5])
+        # a read mostly has only one row, no list for it
+        first_row = next(rows, None)
+        if first_row is None:
+            return None
+        other_rows = list(rows)
+        if len(other_rows) == 0:
+            return _convert_locstr(first_row[4]), _convert_probstr(first_row[5])
         else:
-            locs_0, probs_0 = _convert_locstr(row_list[0][4]), _convert_probstr(row_list[0][5])
-            loc_probs = list(zip(locs_0, probs_0))
-            locs_set = set(locs_0)
-            for ridx in range(1, len(row_list)):
-                locs_tmp, probs_tmp = _convert_locstr(row_list[ridx][4]), _convert_probstr(row_list[ridx][5])
-                for lidx in range(len(locs_tmp)):
-                    if locs_tmp[lidx] not in locs_set:
-                        locs_set.add(locs_tmp[lidx])
-                        loc_probs.append((locs_tmp[lidx], probs_tmp[lidx]))
-            loc_probs = sorted(loc_probs, key=lambda x: x[0])
-            loc_probs = list(zip(*loc_probs))
-            return loc_probs[0], loc_probs[1]
+            row_list = [first_row] + other_rows
+            locs_all = np.concatenate([_convert_locstr(row[4]) for row in row_list])
+            probs_all = np.concatenate([_convert_probstr(row[5]) for row in row_list])
+            # sorted unique locs, the prob of a loc is from the first row it appears in
+            locs, first_idxs = np.unique(locs_all, return_index=True)
+            return locs, probs_all[first_idxs]
     except tabix.TabixError:
         return None
 
@@ -139,87 +117,152 @@ def query_locs_probs_of_a_read(readname, tabixobj):
     return None, None
 
 
-def _convert_locs_to_mmtag(locs, seq_fwseq):
+def query_locs_probs_of_reads(readnames, tabixobj):
+    """
+    query the per-read calls of reads in name order. the per-read file is sorted by read name, so the
+    queries move forward through the file, and alignments of the same read share one query
+    :return: dict, readname -> (locs, probs)
+    """
+    return dict((readname, query_locs_probs_of_a_read(readname, tabixobj)) for readname in sorted(set(readnames)))
+
+
+def _convert_locs_to_mmtag(locs, seq_seq, is_reverse=False):
+    """
+    :param locs: locs of the modified bases in the read (in the original read direction)
+    :param seq_seq: query_sequence of the alignment
+    :param is_reverse: if seq_seq is the reverse complement of the read
+    """
     assert len(locs) > 0
-    base_alllocs = [i.start() for i in re.finditer(base, seq_fwseq)]
-    base_orders = [-1] * len(locs)
-    order_idx = 0
-    for base_idx in range(0, len(base_alllocs)):
-        try:
-            if base_alllocs[base_idx] == locs[order_idx]:
-                base_orders[order_idx] = base_idx
-                order_idx += 1
-        except IndexError:
-            break
-    assert base_orders[-1] != -1
-    mm_idxes = [base_orders[0]]
-    for i in range(1, len(base_orders)):
-        mm_idxes.append(base_orders[i] - 1 - base_orders[i-1])
+    seq_bytes = np.frombuffer(seq_seq.encode(), dtype=np.uint8)
+    if is_reverse:
+        # base of the read is the complement base of seq_seq, counted from the end; no need to rev-comp
+        base_alllocs = (len(seq_bytes) - 1 - np.flatnonzero(seq_bytes == ord(basepairs[base])))[::-1]
+    else:
+        base_alllocs = np.flatnonzero(seq_bytes == ord(base))
+    locs = np.asarray(locs, dtype=np.int64)
+    # order of each loc in all base locs, locs must be increasing base locs
+    base_orders = np.searchsorted(base_alllocs, locs)
+    assert (base_orders < len(base_alllocs)).all()
+    assert (base_alllocs[base_orders] == locs).all()
+    mm_idxes = np.empty(len(base_orders), dtype=np.int64)
+    mm_idxes[0] = base_orders[0]
+    mm_idxes[1:] = base_orders[1:] - 1 - base_orders[:-1]
+    assert (mm_idxes[1:] >= 0).all()
     return mm_idxes
 
 
 def _convert_probs_to_mltag(probs):
-    # force returned values in [0, 255]
-    return [math.floor(prob * 256) if prob < 1 else 255 for prob in probs]
+    # force returned values in [0, 255]; float64, so floor(prob * 256) is the same as in python
+    ml_values = np.clip(np.floor(np.asarray(probs, dtype=np.float64) * 256), 0, 255).astype(np.uint8)
+    # pysam takes array.array('B') as a B:C tag, but not a np.ndarray
+    return array.array('B', ml_values.tobytes())
+
+
+_DROP_TAGS = frozenset(("MM", "ML"))
+_DROP_TAGS_PULSE = _DROP_TAGS | frozenset(("fi", "fp", "ri", "rp"))
+
+
+def _mm_values_to_str(mm_values):
+    # tolist() converts to python ints in C, then map(str) without a python-level loop
+    return 'C+m,' + ",".join(map(str, mm_values.tolist())) + ";"
 
 
 def _refill_tags(all_tags, mm_values, ml_values, rm_pulse=True):
-    new_tags = []
+    drop_tags = _DROP_TAGS_PULSE if rm_pulse else _DROP_TAGS
     # TODO: if with_value_type, pysam has a bug (0.19.0, pysam/libcalignedsegment.pyx line 396)
-    for tagtuple in all_tags:
-        if tagtuple[0] in {"MM", "ML"}:
-            continue
-        if rm_pulse and tagtuple[0] in {"fi", "fp", "ri", "rp"}:
-            continue
-        # new_tags.append(tagtuple)
-        new_tags.append((tagtuple[0], tagtuple[1]))
+    new_tags = [(tagtuple[0], tagtuple[1]) for tagtuple in all_tags if tagtuple[0] not in drop_tags]
     if mm_values is not None:
-        # new_tags.append(('MM', 'C+m,' + ",".join(list(map(str, mm_values))), 'Z'))
-        new_tags.append(('MM', 'C+m,' + ",".join(list(map(str, mm_values))) + ";"))
-        # new_tags.append(('ML', ml_values, 'B'))
+        new_tags.append(('MM', _mm_values_to_str(mm_values)))
         new_tags.append(('ML', ml_values))
     return new_tags
 
 
+def _reset_tags_of_alignedsegment(readitem, mm_values, ml_values, rm_pulse=True):
+    """
+    same as _refill_tags(), but in place, only the tags to be removed/added are touched
+    """
+    drop_tags = _DROP_TAGS_PULSE if rm_pulse else _DROP_TAGS
+    for tag in drop_tags:
+        readitem.set_tag(tag, None)
+    if mm_values is not None:
+        readitem.set_tag('MM', _mm_values_to_str(mm_values), 'Z')
+        readitem.set_tag('ML', ml_values)
+
+
+def _get_mm_ml_values(seq_name, seq_seq, is_reverse, locs, probs):
+    """
+    :param locs: per-read call locs of the read, None if the read has no calls
+    :param probs:
+    :return: (mm_values, ml_values), (None, None) if no calls, None if the alignment should be skipped
+    """
+    # MM: Base modifications / methylation, ML:Base modification probabilities tags
+    # TODO: there are chances that supplementary alignments cannot get corresponding mm/ml values
+    if locs is None:
+        return None, None
+    if seq_seq is None:
+        # e.g., secondary alignments with SEQ '*'
+        sys.stderr.write("no query sequence, skip this alignment-{}.\n".format(seq_name))
+        return None
+    try:
+        return _convert_locs_to_mmtag(locs, seq_seq, is_reverse), _convert_probs_to_mltag(probs)
+    except AssertionError:
+        # sys.stderr.write("AssertionError, skip this alignment.\n"
+        #       "\tDetails: {}, {}, {}\n".format(seq_name, locs, probs))
+        sys.stderr.write("AssertionError, skip this alignment-{}.\n".format(seq_name))
+        return None
+
+
+def _get_new_tags(seq_name, seq_seq, all_tags, is_reverse, locs, probs, rm_pulse=True):
+    """
+    get the tags of an alignment with MM/ML tags added
+    :param locs: per-read call locs of the read, None if the read has no calls
+    :param probs:
+    :return: (new_tags, mm_flag), None if the alignment should be skipped
+    """
+    mm_ml = _get_mm_ml_values(seq_name, seq_seq, is_reverse, locs, probs)
+    if mm_ml is None:
+        return None
+    mm_values, ml_values = mm_ml
+    return _refill_tags(all_tags, mm_values, ml_values, rm_pulse), int(mm_values is not None)
+
+
+def _process_one_alignment(rread, locs, probs, rm_pulse=True):
+    """
+    add MM/ML tags to the items of an alignment
+    :param rread: output of _get_necessary_alignment_items()
+    :return: items to be written by write_alignedsegment(), None if the alignment should be skipped
+    """
+    seq_name, flag, ref_name, ref_start, mapq, cigarstring, rnext, pnext, tlen, \
+        seq_seq, seq_qual, all_tags, is_reverse = rread
+    tags_info = _get_new_tags(seq_name, seq_seq, all_tags, is_reverse, locs, probs, rm_pulse)
+    if tags_info is None:
+        return None
+    new_tags, mm_flag = tags_info
+    return (seq_name, flag, ref_name, ref_start, mapq, cigarstring, rnext, pnext, tlen,
+            seq_seq, seq_qual, new_tags, mm_flag)
+
+
+def _process_reads_batch(reads_batch, perread_tbx, rm_pulse=True):
+    locs_probs = query_locs_probs_of_reads([rread[0] for rread in reads_batch], perread_tbx)
+    wreads = []
+    for rread in reads_batch:
+        locs, probs = locs_probs[rread[0]]
+        wread = _process_one_alignment(rread, locs, probs, rm_pulse)
+        if wread is not None:
+            wreads.append(wread)
+    return wreads
+
+
 def _worker_process_reads_batch(rreads_q, wreads_q, tabix_file, rm_pulse=True):
     # perread_tbx = pysam.TabixFile(tabix_file)
     perread_tbx = tabix.open(tabix_file)
     while True:
-        if rreads_q.empty():
-            time.sleep(time_wait)
-            continue
         reads_batch = rreads_q.get()
         if reads_batch == "kill":
-            rreads_q.put("kill")
             break
-        wreads_tmp = []
-        for rread in reads_batch:
-            seq_name, flag, ref_name, ref_start, mapq, cigartuples, rnext, pnext, tlen, \
-                seq_seq, seq_qual, all_tags, is_reverse = rread
-            seq_fwdseq = complement_seq(seq_seq) if is_reverse else seq_seq
-
-            # MM: Base modifications / methylation, ML:Base modification probabilities tags
-            mm_values = ml_values = None
-            mm_flag = 0
-            # TODO: there are chances that supplementary alignments cannot get corresponding mm/ml values
-            locs, probs = query_locs_probs_of_a_read(seq_name, perread_tbx)
-            if locs is not None:
-                try:
-                    mm_values = _convert_locs_to_mmtag(locs, seq_fwdseq)
-                    ml_values = _convert_probs_to_mltag(probs)
-                    mm_flag = 1
-                except AssertionError:
-                    # sys.stderr.write("AssertionError, skip this alignment.\n"
-                    #       "\tDetails: {}, {}, {}\n".format(seq_name, locs, probs))
-                    sys.stderr.write("AssertionError, skip this alignment-{}.\n".format(seq_name))
-                    continue
-            new_tags = _refill_tags(all_tags, mm_values, ml_values, rm_pulse)
-            wreads_tmp.append((seq_name, flag, ref_name, ref_start, mapq, cigartuples, rnext, pnext, tlen,
-                               seq_seq, seq_qual, new_tags, mm_flag))
+        wreads_tmp = _process_reads_batch(reads_batch, perread_tbx, rm_pulse)
         if len(wreads_tmp) > 0:
             wreads_q.put(wreads_tmp)
-            while wreads_q.qsize() > queue_size_border:
-                time.sleep(time_wait)
 
 
 def write_alignedsegment(readitem_info, output_bam):
@@ -229,7 +272,7 @@ def write_alignedsegment(readitem_info, output_bam):
     :param output_bam:
     :return:
     """
-    seq_name, flag, ref_name, ref_start, mapq, cigartuples, \
+    seq_name, flag, ref_name, ref_start, mapq, cigarstring, \
         rnext, pnext, tlen, seq_seq, seq_qual, all_tags, mm_flag = readitem_info
 
     out_read = pysam.AlignedSegment(output_bam.header)
@@ -238,7 +281,7 @@ def write_alignedsegment(readitem_info, output_bam):
     out_read.reference_name = ref_name
     out_read.reference_start = ref_start
     out_read.mapping_quality = mapq
-    out_read.cigar = cigartuples
+    out_read.cigarstring = cigarstring
     out_read.next_reference_name = rnext
     out_read.next_reference_start = pnext
     out_read.template_length = tlen
@@ -249,15 +292,17 @@ def write_alignedsegment(readitem_info, output_bam):
     output_bam.write(out_read)
 
 
-def _worker_write_modbam(wreads_q, modbamfile, inputbamfile, threads=1):
+def _worker_write_modbam(wreads_q, modbamfile, inputbamfile, threads=1, compresslevel=None):
+    """
+    :param compresslevel: bgzf compression level of modbamfile, None for the default level
+    """
     ori_bam = open_input_bamfile(inputbamfile)
-    w_bam = pysam.AlignmentFile(modbamfile, "wb", template=ori_bam, threads=threads)
+    format_options = None if compresslevel is None else ["level={}".format(compresslevel)]
+    w_bam = pysam.AlignmentFile(modbamfile, "wb", template=ori_bam, threads=threads,
+                                format_options=format_options)
     ori_bam.close()
     cnt_w, cnt_mm = 0, 0
     while True:
-        if wreads_q.empty():
-            time.sleep(time_wait)
-            continue
         wreads_batch = wreads_q.get()
         if wreads_batch == "kill":
             w_bam.close()
@@ -271,20 +316,123 @@ def _worker_write_modbam(wreads_q, modbamfile, inputbamfile, threads=1):
             cnt_mm += mm_flag
 
 
-def add_mm_ml_tags_to_bam(bamfile, per_readsite, modbamfile,
-                          rm_pulse=True, threads=3,
-                          reads_batch=100, mode="align"):
-    sys.stderr.write("[generate_modbam_file]starts\n")
-    start = time.time()
+def _split_regions_by_index(bamfile, nbins, npieces_per_bin=4):
+    """
+    split the contigs of an indexed bam into regions, and the regions into at most nbins bins of consecutive
+    regions with similar numbers of reads (by index statistics, assuming reads are evenly distributed in a
+    contig). as the input is coordinate-sorted, concatenating the outputs of the bins in order keeps it sorted
+    :return: list of region (contig, start, end) lists, or None if the index statistics are not available
+    """
+    try:
+        with pysam.AlignmentFile(bamfile, 'rb') as ori_bam:
+            contig_stats = [(stat.contig, ori_bam.get_reference_length(stat.contig), stat.total)
+                            for stat in ori_bam.get_index_statistics() if stat.total > 0]
+    except (ValueError, AttributeError):
+        return None
+    nbins = max(1, nbins)
+    total_reads = sum([x[2] for x in contig_stats])
+    reads_per_piece = max(1, total_reads // (nbins * npieces_per_bin))
+    reads_per_bin = total_reads / nbins
+    region_bins = [[]]
+    bin_load = 0
+    for contig, contig_len, nreads in contig_stats:
+        npieces = max(1, nreads // reads_per_piece)
+        piece_len = -(-contig_len // npieces)
+        for start in range(0, contig_len, piece_len):
+            if bin_load >= reads_per_bin and len(region_bins) < nbins:
+                region_bins.append([])
+                bin_load = 0
+            region_bins[-1].append((contig, start, min(start + piece_len, contig_len)))
+            bin_load += nreads / npieces
+    return region_bins
+
+
+def _worker_process_regions(bamfile, regions, tabix_file, modbam_part, rm_pulse=True, with_unplaced=False,
+                            batch_size=100):
+    """
+    read, add MM/ML tags and write the alignments of regions in one process, no queues needed.
+    an alignment belongs to the region its reference_start is in, so alignments are not handled twice
+    :param with_unplaced: if also handle the unmapped reads with no coordinate
+    """
+    perread_tbx = tabix.open(tabix_file)
+    ori_bam = pysam.AlignmentFile(bamfile, 'rb')
+    w_bam = pysam.AlignmentFile(modbam_part, "wb", template=ori_bam)
+    cnt_all, cnt_w, cnt_mm = 0, 0, 0
+    fetch_args = [(contig, start, end) for contig, start, end in regions]
+    if with_unplaced:
+        fetch_args.append(("*", 0, None))
+
+    def _handle_reads_batch(reads_batch):
+        # the original alignments are written with their tags changed in place, no need to rebuild them
+        locs_probs = query_locs_probs_of_reads([readitem.query_name for readitem in reads_batch], perread_tbx)
+        cnt_w_batch, cnt_mm_batch = 0, 0
+        for readitem in reads_batch:
+            locs, probs = locs_probs[readitem.query_name]
+            mm_ml = _get_mm_ml_values(readitem.query_name, readitem.query_sequence, readitem.is_reverse,
+                                      locs, probs)
+            if mm_ml is None:
+                continue
+            _reset_tags_of_alignedsegment(readitem, mm_ml[0], mm_ml[1], rm_pulse)
+            w_bam.write(readitem)
+            cnt_w_batch += 1
+            cnt_mm_batch += int(mm_ml[0] is not None)
+        return cnt_w_batch, cnt_mm_batch
 
-    sys.stderr.write("generating per_read mod_calls..\n")
-    per_read_file = _generate_sorted_per_read_calls(per_readsite, None)
+    reads_batch = []
+    for contig, start, end in fetch_args:
+        for readitem in ori_bam.fetch(contig, start, end):
+            if contig != "*" and readitem.reference_start < start:
+                continue
+            cnt_all += 1
+            reads_batch.append(readitem)
+            if len(reads_batch) == batch_size:
+                cnt_w_batch, cnt_mm_batch = _handle_reads_batch(reads_batch)
+                cnt_w += cnt_w_batch
+                cnt_mm += cnt_mm_batch
+                reads_batch = []
+    cnt_w_batch, cnt_mm_batch = _handle_reads_batch(reads_batch)
+    cnt_w += cnt_w_batch
+    cnt_mm += cnt_mm_batch
+    w_bam.close()
+    ori_bam.close()
+    sys.stderr.write("read {} reads, write {} reads, in which {} were added mm tags\n".format(cnt_all,
+                                                                                           cnt_w,
+                                                                                           cnt_mm))
 
-    sys.stderr.write("add per_read mod_calls to bam file..\n")
-    rreads_q = Queue()
-    wreads_q = Queue()
 
-    nproc = threads
+def _add_mm_ml_tags_by_regions(bamfile, region_bins, per_read_file, modbamfile, rm_pulse=True, reads_batch=100):
+    """
+    the parts written by the processes are in the order of the input, so they are concatenated without sorting
+    """
+    modbam_parts = []
+    ps_gen = []
+    for bin_idx, regions in enumerate(region_bins):
+        modbam_part = modbamfile + ".part{}.bam".format(bin_idx)
+        p_gen = mp.Process(target=_worker_process_regions,
+                           args=(bamfile, regions, per_read_file, modbam_part, rm_pulse,
+                                 bin_idx == len(region_bins) - 1, reads_batch))
+        p_gen.daemon = True
+        p_gen.start()
+        ps_gen.append(p_gen)
+        modbam_parts.append(modbam_part)
+    for p in ps_gen:
+        p.join()
+    # a crashed process leaves a truncated part, keep the parts for debugging instead of concatenating them
+    failed_parts = [modbam_part for p, modbam_part in zip(ps_gen, modbam_parts) if p.exitcode != 0]
+    if len(failed_parts) > 0:
+        raise RuntimeError("failed adding MM/ML tags to the alignments of {}, "
+                           "parts kept: {}".format(", ".join(failed_parts), ", ".join(modbam_parts)))
+    if len(modbam_parts) == 1:
+        os.rename(modbam_parts[0], modbamfile)
+    else:
+        pysam.cat("-o", modbamfile, *modbam_parts)
+        for modbam_part in modbam_parts:
+            os.remove(modbam_part)
+
+
+def _add_mm_ml_tags_by_queues(bamfile, per_read_file, modbamfile, rm_pulse, nproc, reads_batch, use_shm=False,
+                              compresslevel=None):
+    # reader, writer and at least one worker
     if nproc < 5:
         nproc = 5
     if nproc > 8:
@@ -294,6 +442,25 @@ def add_mm_ml_tags_to_bam(bamfile, per_readsite, modbamfile,
     else:
         threads_r, threads_w = 2, 2
 
+    # bounded queues, put() blocks when consumers fall behind
+    if use_shm and SharedMemoryQueue is None:
+        sys.stderr.write("--use_shm needs the ccsmeth package installed, use pipes instead\n")
+        use_shm = False
+    if use_shm:
+        shm_bytes = 2 * nproc * 3 * reads_batch * shm_bytes_per_read
+        shm_free = get_shm_free_bytes()
+        if shm_free is not None and shm_bytes > shm_free:
+            # writing to a full /dev/shm kills the process by SIGBUS
+            sys.stderr.write("--use_shm needs {:.1f}MB but only {:.1f}MB free in /dev/shm, "
+                             "use pipes instead\n".format(shm_bytes / 1024 ** 2, shm_free / 1024 ** 2))
+            use_shm = False
+    if use_shm:
+        rreads_q = SharedMemoryQueue(nproc * 3, reads_batch * shm_bytes_per_read)
+        wreads_q = SharedMemoryQueue(nproc * 3, reads_batch * shm_bytes_per_read)
+    else:
+        rreads_q = Queue(maxsize=queue_size_border)
+        wreads_q = Queue(maxsize=queue_size_border)
+
     p_read = mp.Process(target=_worker_reader,
                         args=(bamfile, reads_batch, rreads_q, threads_r))
     p_read.daemon = True
@@ -307,26 +474,69 @@ def add_mm_ml_tags_to_bam(bamfile, per_readsite, modbamfile,
         p_gen.start()
         ps_gen.append(p_gen)
 
-    fname, fext = os.path.splitext(bamfile)
-    if modbamfile is None:
-        modbamfile = fname + ".modbam.bam"
     p_w = mp.Process(target=_worker_write_modbam,
-                     args=(wreads_q, modbamfile, bamfile, threads_w))
+                     args=(wreads_q, modbamfile, bamfile, threads_w, compresslevel))
     p_w.daemon = True
     p_w.start()
 
+    # one kill per worker after all reads are put, workers do not need to pass the kill on
+    p_read.join()
+    for _ in ps_gen:
+        rreads_q.put("kill")
     for p in ps_gen:
         p.join()
-    p_read.join()
     wreads_q.put("kill")
     p_w.join()
 
-    if modbamfile.endswith(".bam") and mode == "align":
-        sys.stderr.write("sorting and indexing new bam file..\n")
-        modbam_sorted = modbamfile + ".sorted.bam"
-        pysam.sort("-o", modbam_sorted, "-@", str(threads), modbamfile)
-        os.rename(modbam_sorted, modbamfile)
-        pysam.index("-@", str(threads), modbamfile)
+    if use_shm:
+        for shm_q in (rreads_q, wreads_q):
+            shm_q.close()
+            shm_q.unlink()
+
+
+def _get_ncpus_available():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def add_mm_ml_tags_to_bam(bamfile, per_readsite, modbamfile,
+                          rm_pulse=True, threads=3,
+                          reads_batch=100, mode="align", use_shm=False):
+    sys.stderr.write("[generate_modbam_file]starts\n")
+    start = time.time()
+
+    sys.stderr.write("generating per_read mod_calls..\n")
+    per_read_file = _generate_sorted_per_read_calls(per_readsite, None)
+
+    sys.stderr.write("add per_read mod_calls to bam file..\n")
+    # no more processes/threads than the cpus this process is allowed to use (e.g., in a container/HPC job)
+    threads = max(1, min(threads, _get_ncpus_available()))
+
+    fname, fext = os.path.splitext(bamfile)
+    if modbamfile is None:
+        modbamfile = fname + ".modbam.bam"
+
+    # aligned+indexed bam: each process reads/writes the alignments of its own regions, no reader/writer
+    region_bins = None
+    if mode == "align" and bamfile.endswith(".bam"):
+        region_bins = _split_regions_by_index(bamfile, threads)
+    if region_bins is not None:
+        _add_mm_ml_tags_by_regions(bamfile, region_bins, per_read_file, modbamfile, rm_pulse, reads_batch)
+        if modbamfile.endswith(".bam"):
+            sys.stderr.write("indexing new bam file..\n")
+            pysam.index("-@", str(threads), modbamfile)
+    else:
+        to_sort = modbamfile.endswith(".bam") and mode == "align"
+        # the unsorted bam is only read once by sort, fast compression is enough
+        _add_mm_ml_tags_by_queues(bamfile, per_read_file, modbamfile, rm_pulse, threads,
+                                  reads_batch, use_shm, 1 if to_sort else None)
+        if to_sort:
+            sys.stderr.write("sorting and indexing new bam file..\n")
+            modbam_sorted = modbamfile + ".sorted.bam"
+            pysam.sort("-o", modbam_sorted, "-@", str(threads), modbamfile)
+            os.rename(modbam_sorted, modbamfile)
+            pysam.index("-@", str(threads), modbamfile)
 
     if os.path.exists(per_read_file):
         os.remove(per_read_file)
@@ -354,12 +564,15 @@ def main():
                         required=False, help="number of threads to be used, default 10.")
     parser.add_argument("--batch_size", type=int, required=False, default=100,
                         help="batch size of reads to be processed at one time, default 100")
+    parser.add_argument("--use_shm", action="store_true", default=False, required=False,
+                        help="[EXPERIMENTAL]pass read batches between processes through shared memory "
+                             "instead of pipes, needs enough space in /dev/shm")
 
     args = parser.parse_args()
 
     add_mm_ml_tags_to_bam(args.bam, args.per_readsite, args.modbam,
                           args.rm_pulse, args.threads, args.batch_size,
-                          args.mode)
+                          args.mode, args.use_shm)
 
 
 if __name__ == '__main__':